@@ -1,13 +1,19 @@
 import asyncio
 import os
-from typing import List, Optional, Dict
+import re
+from collections import deque
+from operator import itemgetter
+from typing import Deque, List, Optional, Dict, Tuple
 
+import numpy as np
+import requests
 from dotenv import load_dotenv
 from langchain_core.documents import Document
 from langchain_core.messages import BaseMessage, ToolMessage, HumanMessage, ChatMessage
 from langchain_core.prompts import PromptTemplate
-from langchain_core.runnables import RunnableLambda, RunnablePassthrough
+from langchain_core.runnables import RunnableLambda
 from langchain_nvidia_ai_endpoints import NVIDIAEmbeddings, ChatNVIDIA
+from requests.adapters import HTTPAdapter
 from langgraph.graph import MessageGraph, END
 from langgraph.graph.graph import CompiledGraph
 from langgraph.prebuilt import ToolNode
@@ -15,6 +21,7 @@ from langchain_core.tools import tool
 from langchain_community.vectorstores import SurrealDBStore
 from langchain_community.tools import DuckDuckGoSearchRun
 from langchain_core.pydantic_v1 import BaseModel, Field
+from batch_embeddings import DynamicBatchEmbeddings
 from tool_calling_model import create_tool_calling_model
 import logging
 
@@ -33,20 +40,67 @@ _nvidia_vllm_model = (os.environ["NVIDIA_VLLM_MODEL"]
 _nvidia_llm_model = (os.environ["NVIDIA_LLM_MODEL"]
                      if "NVIDIA_LLM_MODEL" in os.environ
                      else "meta/llama3-8b-instruct")
+# retrieved outfits at or above this similarity are returned without asking the llm to rank them.
+# off unless set, the threshold depends on the embedding model and has to be calibrated against it
+_direct_match_similarity = (float(os.environ["OUTFIT_DIRECT_MATCH_SIMILARITY"])
+                            if "OUTFIT_DIRECT_MATCH_SIMILARITY" in os.environ
+                            else None)
+# recent outfit requests at or above this similarity are answered with their cached image urls.
+# off unless set, requests that differ in a single attribute, like the color, can score very close to 1
+_query_cache_similarity = (float(os.environ["OUTFIT_QUERY_CACHE_SIMILARITY"])
+                           if "OUTFIT_QUERY_CACHE_SIMILARITY" in os.environ
+                           else None)
+_llm_ranking = ((os.environ["OUTFIT_LLM_RANKING"]
+                 if "OUTFIT_LLM_RANKING" in os.environ
+                 else "true").lower() == "true")
 
-_vllm = ChatNVIDIA(model=_nvidia_vllm_model)
-_llm = nvidia_functions(model=_nvidia_llm_model)
-_nvidia_embed = NVIDIAEmbeddings(model=_nvidia_embed_model)
-_sdb = SurrealDBStore(embedding_function=_nvidia_embed)
+# the nvidia clients open a new session for every call, share one so connections are kept alive.
+# it is used from the default executor's threads, so keep as many pooled connections as it has workers
+_HTTP_POOL_SIZE = min(32, (os.cpu_count() or 1) + 4)
+_http_session = requests.Session()
+_http_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=_HTTP_POOL_SIZE)
+_http_session.mount("https://", _http_adapter)
+_http_session.mount("http://", _http_adapter)
+
+
+def _with_shared_session(model):
+    # private api; relies on the NVEModel.get_session_fn field reached through _client.client
+    # in the pinned langchain-nvidia-ai-endpoints 0.1.2
+    model._client.client.get_session_fn = lambda: _http_session
+    return model
+
+
+_vllm = _with_shared_session(ChatNVIDIA(model=_nvidia_vllm_model))
+_llm = _with_shared_session(nvidia_functions(model=_nvidia_llm_model))
+_nvidia_embed = _with_shared_session(NVIDIAEmbeddings(model=_nvidia_embed_model))
+_batched_embed = DynamicBatchEmbeddings(_nvidia_embed)
+_sdb = SurrealDBStore(embedding_function=_batched_embed)
+
+
+_sdb_ready = asyncio.Event()
+_sdb_lock = asyncio.Lock()
+
+
+async def initialize_store():
+    # initialize opens a new connection each time, so only do it once
+    if _sdb_ready.is_set():
+        return
+    async with _sdb_lock:
+        if not _sdb_ready.is_set():
+            await _sdb.initialize()
+            _sdb_ready.set()
+
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
 
 
 def _strip_content(content: str) -> str:
-    return " ".join([line.strip() for line in content.split("\n")])
+    return _WHITESPACE_PATTERN.sub(" ", content).strip()
 
 
 def _format_documents_for_query(docs: List[Document]) -> str:
-    return "\n\n".join([f"document id: {doc.metadata["id"]}\n"
-                        f"outfit description: {_strip_content(doc.page_content)}" for doc in docs])
+    return "\n\n".join(f"document id: {doc.metadata["id"]}\n"
+                       f"outfit description: {_strip_content(doc.page_content)}" for doc in docs)
 
 
 class ListOfDocumentIds(BaseModel):
@@ -57,56 +111,39 @@ class ListOfDocumentIds(BaseModel):
     document_ids: Optional[List[str]] = Field(description="List of document ids")
 
 
-@tool
-async def outfit_recommender(request: str, context: Optional[str]) -> [List[str] | str]:
-    """
-    Outfit retriever tool takes an outfit search query and returns a list of outfits from the library
-    of outfits. The request must include specifics like colors or style or occasion or venue.
-    There may be some additional context that may be included request such as colors, styles, etc.
-    The request must start with phrase "Show me".
-    """
-    logger.info(f"Outfit recommender request: {request}, context: {context}")
-    if context is not None and len(context) > 0:
-        prompt = PromptTemplate.from_examples(
-            prefix="You are a user request pre-processor. Review user's original request and the provided context. """
-                   "Rephrase the original request with any additional information from the context. "
-                   "If no context is provided, then the rephrased request is the same as the original request.\n\n"
-                   "See examples below:\n",
-            examples=[
-                "Example #1\n"
-                "Context: \n"
-                "Original Request: What is the capital of France?\n"
-                "Rephrased Request: What is the capital of France?",
-                "Example #2\n"
-                "Context: Alice has a brother, named Bob.\n"
-                "Original Request: What is Alice's brother's age?\n"
-                "Rephrased Request: How old is Bob?",
-                "Example #3\n"
-                "Context: You put the bowl on the table.\n"
-                "Original Request: You put cereal in it.\n"
-                "Rephrased Request: You put cereal in the bowl on the table.",
-                "Example #4\n"
-                "Context: I have a red jacket.\n"
-                "Original Request: I need matching shoes.\n"
-                "Rephrased Request: I need matching shoes for my red jacket.",
-            ],
-            suffix="End of examples\n\n"
-                   "Rephrase the below request\n\n"
-                   "Context: {context}\n"
-                   "Original Request: {request}\n"
-                   "Rephrased Request: ",
-            input_variables=["request", "context"]
-        )
-        chain = prompt | _llm
-        response = chain.invoke({"request": request, "context": context})
-        new_request = response.content
-    else:
-        new_request = request
-
-    logger.info(f"Outfit recommender pre-processor response: {new_request}")
-
-    retrieval_prompt = PromptTemplate.from_template(
-        """Review the outfit descriptions below and find all that match the user's criteria.
+_REPHRASE_PROMPT = PromptTemplate.from_examples(
+    prefix="You are a user request pre-processor. Review user's original request and the provided context. """
+           "Rephrase the original request with any additional information from the context. "
+           "If no context is provided, then the rephrased request is the same as the original request.\n\n"
+           "See examples below:\n",
+    examples=[
+        "Example #1\n"
+        "Context: \n"
+        "Original Request: What is the capital of France?\n"
+        "Rephrased Request: What is the capital of France?",
+        "Example #2\n"
+        "Context: Alice has a brother, named Bob.\n"
+        "Original Request: What is Alice's brother's age?\n"
+        "Rephrased Request: How old is Bob?",
+        "Example #3\n"
+        "Context: You put the bowl on the table.\n"
+        "Original Request: You put cereal in it.\n"
+        "Rephrased Request: You put cereal in the bowl on the table.",
+        "Example #4\n"
+        "Context: I have a red jacket.\n"
+        "Original Request: I need matching shoes.\n"
+        "Rephrased Request: I need matching shoes for my red jacket.",
+    ],
+    suffix="End of examples\n\n"
+           "Rephrase the below request\n\n"
+           "Context: {context}\n"
+           "Original Request: {request}\n"
+           "Rephrased Request: ",
+    input_variables=["request", "context"]
+)
+
+_RETRIEVAL_PROMPT = PromptTemplate.from_template(
+    """Review the outfit descriptions below and find all that match the user's criteria.
 Return all document ids for the matching outfits.
 Document Ids must always begin with "documents:" prefix.
 Only return the list of document ids that match the user's criteria.
@@ -122,24 +159,129 @@ User criteria
 Matching Document IDs
 """)
 
-    await _sdb.initialize()
-    retriever = _sdb.as_retriever()
+_ORACLE_PROMPT = PromptTemplate.from_template("""Review the request and answer it based on the context provided. 
 
-    async def get_image_urls(doc_ids: ListOfDocumentIds) -> List[str]:
-        documents = [await _sdb.sdb.select(doc_id) for doc_id in doc_ids.document_ids]
-        return [doc["metadata"]["image_url"] for doc in documents]
+    Request:
+    {request}
+
+    Context:
+    {context}
+
+    Response:
+    """)
+
+_SUMMARIZE_PROMPT = PromptTemplate.from_template("""Review the request and provide a short one line response in simple 
+    language based on the context. 
+
+    Request:
+    {request}
+
+    Context:
+    {context}
+
+    Response:
+    """)
+
+# number of prior messages (user requests and responses) included as oracle context
+_CONTEXT_WINDOW = 6
+
+_rephrase_chain = _REPHRASE_PROMPT | _llm
+_summarize_chain = _SUMMARIZE_PROMPT | _llm
+
+_RECORD_ID_PATTERN = re.compile(r"documents:\w+")
+_document_ids_llm = _llm.with_structured_output(ListOfDocumentIds)
+
+# semantic cache of recent outfit requests: (normalized request embedding, image urls)
+_QUERY_CACHE_SIZE = 64
+_query_cache: Deque[Tuple[np.ndarray, List[str]]] = deque(maxlen=_QUERY_CACHE_SIZE)
+
+
+def _normalize(vector: List[float]) -> np.ndarray:
+    array = np.asarray(vector, dtype=np.float32)
+    return array / (np.linalg.norm(array) or 1.0)
 
-    retrieval_chain = (
-            {
-                "documents": retriever | _format_documents_for_query,
-                "criteria": RunnablePassthrough()
-            } | retrieval_prompt | _llm.with_structured_output(ListOfDocumentIds)
-            | RunnableLambda(func=get_image_urls)
-    )
+
+def _lookup_query_cache(vector: np.ndarray) -> Optional[List[str]]:
+    if _query_cache_similarity is None or len(_query_cache) == 0:
+        return None
+    similarities = np.stack([cached for cached, _ in _query_cache]) @ vector
+    best = int(np.argmax(similarities))
+    if similarities[best] < _query_cache_similarity:
+        return None
+    entry = _query_cache[best]
+    # move the hit to the most recently used end
+    del _query_cache[best]
+    _query_cache.append(entry)
+    return entry[1]
+
+
+_RANKING_CHAIN = (
+        {
+            "documents": itemgetter("documents") | RunnableLambda(func=_format_documents_for_query),
+            "criteria": itemgetter("criteria")
+        } | _RETRIEVAL_PROMPT | _document_ids_llm
+)
+
+
+async def _select_document_ids(query: Dict) -> ListOfDocumentIds:
+    # private api; relies on the (document, score, embedding) tuples returned by the pinned langchain-community 0.2.5
+    scored_documents = await _sdb._asimilarity_search_by_vector_with_score(query["embedding"])
+    documents = ([document for document, score, _ in scored_documents if score >= _direct_match_similarity]
+                 if _direct_match_similarity is not None
+                 else [])
+    if len(documents) == 0:
+        documents = [document for document, _, _ in scored_documents]
+        if _llm_ranking and len(documents) > 0:
+            # no clear matches, let the llm pick from the retrieved outfits
+            return await _RANKING_CHAIN.ainvoke({"criteria": query["criteria"], "documents": documents})
+    return ListOfDocumentIds(document_ids=[document.metadata["id"] for document in documents])
+
+
+async def _get_image_urls(doc_ids: ListOfDocumentIds) -> List[str]:
+    # fetch all matches in a single round-trip; the surreal client serializes requests on one socket
+    record_ids = [doc_id for doc_id in doc_ids.document_ids or [] if _RECORD_ID_PATTERN.fullmatch(doc_id)]
+    if len(record_ids) == 0:
+        return []
+    response = await _sdb.sdb.query(f"SELECT VALUE metadata.image_url FROM {", ".join(record_ids)}")
+    # failed statements come back with an error string as the result instead of raising
+    if response[0]["status"] != "OK":
+        raise ValueError(f"Error retrieving image urls: {response[0]["result"]}")
+    return response[0]["result"]
+
+
+_RETRIEVAL_CHAIN = RunnableLambda(func=_select_document_ids) | RunnableLambda(func=_get_image_urls)
+
+
+@tool
+async def outfit_recommender(request: str, context: Optional[str]) -> [List[str] | str]:
+    """
+    Outfit retriever tool takes an outfit search query and returns a list of outfits from the library
+    of outfits. The request must include specifics like colors or style or occasion or venue.
+    There may be some additional context that may be included request such as colors, styles, etc.
+    The request must start with phrase "Show me".
+    """
+    logger.info(f"Outfit recommender request: {request}, context: {context}")
+    if context is not None and len(context) > 0:
+        response = await _rephrase_chain.ainvoke({"request": request, "context": context})
+        new_request = response.content
+    else:
+        new_request = request
+
+    logger.info(f"Outfit recommender pre-processor response: {new_request}")
 
     try:
+        await initialize_store()
         async with asyncio.timeout(10):
-            image_urls: List[str] = await retrieval_chain.ainvoke(new_request)
+            embedding = await _batched_embed.aembed_query(new_request)
+            query_vector = _normalize(embedding)
+            image_urls = _lookup_query_cache(query_vector)
+            if image_urls is not None:
+                logger.info(f"Outfit recommender cache hit with {len(image_urls)} matches")
+                return image_urls
+            image_urls = await _RETRIEVAL_CHAIN.ainvoke({"criteria": new_request, "embedding": embedding})
+        # don't let a request without matches answer the similar requests that follow it
+        if _query_cache_similarity is not None and len(image_urls) > 0:
+            _query_cache.append((query_vector, image_urls))
         logger.info(f"Outfit recommender found {len(image_urls)} matches")
         return image_urls
     except Exception as e:
@@ -150,49 +292,56 @@ Matching Document IDs
 
 _tools = [DuckDuckGoSearchRun(max_results=5), outfit_recommender]
 _llm_with_tools = _llm.bind_tools(_tools)
+_oracle_chain = _ORACLE_PROMPT | _llm_with_tools
 _tool_node = ToolNode(_tools)
 
 
-async def process_image(filename: str, image_url: str):
-    class Outfit(BaseModel):
-        detailed_description: str = Field(description="A very detailed description of the picture")
-        outfit_description: str = Field(description="A very detailed description of the outfit of the primary "
-                                                    "subject. Include color of the outfit, style of the outfit, "
-                                                    "and any additional identifying detail that can be helpful when "
-                                                    "looking up this outfit.")
-        outfit_type: str = Field(
-            description="Type of outfit. example: shirt, trousers, blouse, jacket, shorts, skirt, etc")
-        colors: List[str] = Field(description="List of all colors of the outfit")
-        weather: str = Field(description="Weather conditions suitable for the outfit")
-
-    def get_image_prompt(_image_url: str) -> List[BaseMessage]:
-        return [HumanMessage(
-            content=[
-                {
-                    "type": "text", "text": "You are an expert fashion classifier. Your task is to review the "
-                                            "provided image and identify different characteristics about the outfits, "
-                                            "such as color, style, pattern etc. You must also identify whether the "
-                                            "outfit is formal, casual, etc, and what weather it is most suitable for. "
-                                            "Focus only on the outfit and ignore everything else in the image, "
-                                            "like the location, furniture, etc. Provide as much detail as possible."
-                },
-                {
-                    "type": "image_url", "image_url": _image_url
-                },
-            ]
-        )]
-
-    def get_message_content(msg: ChatMessage) -> str:
-        if isinstance(msg.content, str):
-            return msg.content
-        else:
-            return msg.content[0]["text"]
-
-    outfit_output_llm = _llm.with_structured_output(Outfit, include_raw=False)
-    nv_fc_chain = RunnableLambda(get_image_prompt) | _vllm | RunnableLambda(get_message_content) | outfit_output_llm
+class Outfit(BaseModel):
+    detailed_description: str = Field(description="A very detailed description of the picture")
+    outfit_description: str = Field(description="A very detailed description of the outfit of the primary "
+                                                "subject. Include color of the outfit, style of the outfit, "
+                                                "and any additional identifying detail that can be helpful when "
+                                                "looking up this outfit.")
+    outfit_type: str = Field(
+        description="Type of outfit. example: shirt, trousers, blouse, jacket, shorts, skirt, etc")
+    colors: List[str] = Field(description="List of all colors of the outfit")
+    weather: str = Field(description="Weather conditions suitable for the outfit")
+
+
+_IMAGE_PROMPT_TEXT = ("You are an expert fashion classifier. Your task is to review the "
+                      "provided image and identify different characteristics about the outfits, "
+                      "such as color, style, pattern etc. You must also identify whether the "
+                      "outfit is formal, casual, etc, and what weather it is most suitable for. "
+                      "Focus only on the outfit and ignore everything else in the image, "
+                      "like the location, furniture, etc. Provide as much detail as possible.")
+
+
+def _get_image_prompt(image_url: str) -> List[BaseMessage]:
+    return [HumanMessage(
+        content=[
+            {
+                "type": "text", "text": _IMAGE_PROMPT_TEXT
+            },
+            {
+                "type": "image_url", "image_url": image_url
+            },
+        ]
+    )]
+
+
+def _get_message_content(msg: ChatMessage) -> str:
+    content = msg.content
+    return content if isinstance(content, str) else content[0].get("text", "")
+
 
+_outfit_output_llm = _llm.with_structured_output(Outfit, include_raw=False)
+_image_chain = (RunnableLambda(_get_image_prompt) | _vllm | RunnableLambda(_get_message_content)
+                | _outfit_output_llm)
+
+
+async def process_image(filename: str, image_url: str):
     try:
-        result = await nv_fc_chain.ainvoke(image_url)
+        result = await _image_chain.ainvoke(image_url)
         print(result)
         metadata = {
             "file": filename,
@@ -212,55 +361,35 @@ async def process_image(filename: str, image_url: str):
         Suitable for {result.weather} weather.
         """
         document = Document(page_content=page_content, metadata=metadata)
-        await _sdb.initialize()
+        await initialize_store()
         ids = await _sdb.aadd_documents([document])
+        # cached recommendations do not include the new outfit
+        _query_cache.clear()
         logger.info(f"Outfit uploaded: {ids}")
     except Exception as e:
         logger.error(e)
 
 
-def _oracle_node(messages: List[BaseMessage]) -> BaseMessage:
+async def _oracle_node(messages: List[BaseMessage]) -> BaseMessage:
     logger.info("Oracle node")
     request = messages[-1]
-    context = messages[:-1] if len(messages) > 1 else []
-    prompt = PromptTemplate.from_template("""Review the request and answer it based on the context provided. 
-
-    Request:
-    {request}
-
-    Context:
-    {context}
-
-    Response:
-    """)
-    chain = prompt | _llm_with_tools
-    response = chain.invoke({"request": request.content, "context": context})
+    # only the most recent turns go into the prompt so its size doesn't grow with the conversation
+    context = messages[-_CONTEXT_WINDOW - 1:-1]
+    response = await _oracle_chain.ainvoke({"request": request.content, "context": context})
     logger.info(f"Oracle node response: {response.content}")
     return response
 
 
-def _summarize_node(messages: List[BaseMessage]) -> Optional[BaseMessage]:
+async def _summarize_node(messages: List[BaseMessage]) -> Optional[BaseMessage]:
     logger.info("Summarize node")
     last_message = messages[-1]
     if not isinstance(last_message, ToolMessage) or (
-            last_message.content[0] == '[' and last_message.content[-1] == ']'):
+            last_message.content.startswith('[') and last_message.content.endswith(']')):
         return None
-    if last_message.content[:5] == "Error":
+    if last_message.content.startswith("Error"):
         return None
     request = [message for message in messages if isinstance(message, HumanMessage)][-1]
-    prompt = PromptTemplate.from_template("""Review the request and provide a short one line response in simple 
-    language based on the context. 
-
-    Request:
-    {request}
-
-    Context:
-    {context}
-
-    Response:
-    """)
-    chain = prompt | _llm
-    response = chain.invoke({"request": request.content, "context": last_message.content})
+    response = await _summarize_chain.ainvoke({"request": request.content, "context": last_message.content})
     logger.info(f"Summarize node response: {response.content}")
     return response
 
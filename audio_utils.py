@@ -1,13 +1,16 @@
 import asyncio
-import os
+import re
 import uuid
-from typing import List
+from typing import Iterator, List
 
+import numpy as np
 import torch
-from scipy.io import wavfile
 from transformers import WhisperProcessor, WhisperForConditionalGeneration, AutoProcessor, BarkModel
 
 
+_SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+")
+
+
 class Whisper:
     def __init__(self, model_name="openai/whisper-small"):
         self.__device = "cuda:0" if torch.cuda.is_available() else "cpu"
@@ -27,6 +30,9 @@ class Whisper:
         transcription = self.__processor.batch_decode(predicted_ids, skip_special_tokens=True)
         return transcription
 
+    def warmup(self):
+        self.transcribe(np.zeros(16000, dtype=np.float32))
+
 
 class Bark:
     def __init__(self, model_name="suno/bark-small", voice_preset="v2/en_speaker_0"):
@@ -35,23 +41,26 @@ class Bark:
         self.__model = BarkModel.from_pretrained(model_name).to(self.__device)
         self.__synthesiser = AutoProcessor.from_pretrained(model_name)
         self.__voice_preset = voice_preset
-        self.__filename = None
 
     def set_voice_preset(self, voice_preset):
         self.__voice_preset = voice_preset
 
-    def set_filename(self, filename):
-        self.__filename = filename
-        if not os.path.exists(self.__filename):
-            with open(self.__filename, "wb") as f:
-                with open("silence.wav", "rb") as s:
-                    f.write(s.read())
+    @property
+    def sample_rate(self) -> int:
+        return self.__model.generation_config.sample_rate
 
-    def synthesize(self, text: str):
+    def synthesize(self, text: str) -> np.ndarray:
         input_features = self.__synthesiser(f"{text}", voice_preset=self.__voice_preset).to(self.__device)
         audio_array = self.__model.generate(**input_features)
         if self.__device != "cpu":
             audio_array = audio_array.to(self.__device, torch.float32)
-        audio_array = audio_array.cpu().numpy().squeeze()
-        sample_rate = self.__model.generation_config.sample_rate
-        wavfile.write(self.__filename, rate=sample_rate, data=audio_array)
+        return audio_array.cpu().numpy().squeeze()
+
+    def warmup(self):
+        self.synthesize("Hello.")
+
+    def synthesize_stream(self, text: str) -> Iterator[np.ndarray]:
+        # bark generates a whole utterance at a time, so stream sentence by sentence
+        for sentence in _SENTENCE_BOUNDARY.split(text.strip()):
+            if len(sentence) > 0:
+                yield self.synthesize(sentence)
@@ -0,0 +1,68 @@
+import asyncio
+from asyncio import AbstractEventLoop, Future, Task, TimerHandle
+from typing import Dict, List, Optional, Set, Tuple
+
+from langchain_core.embeddings import Embeddings
+from langchain_nvidia_ai_endpoints import NVIDIAEmbeddings
+
+
+class _PendingBatch:
+    def __init__(self):
+        self.requests: List[Tuple[str, Future]] = []
+        self.timer: Optional[TimerHandle] = None
+
+
+class DynamicBatchEmbeddings(Embeddings):
+    """Coalesces concurrent query embeddings into a single batched request to the embeddings endpoint."""
+
+    def __init__(self, embeddings: NVIDIAEmbeddings, max_batch_size: int = 32, max_wait: float = 0.01):
+        self.embeddings = embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._pending: Dict[AbstractEventLoop, _PendingBatch] = {}
+        # the event loop only keeps weak references to tasks
+        self._tasks: Set[Task] = set()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(loop, _PendingBatch())
+        batch.requests.append((text, future))
+        if len(batch.requests) >= self.max_batch_size:
+            self._flush(loop)
+        elif batch.timer is None:
+            batch.timer = loop.call_later(self.max_wait, self._flush, loop)
+        return await future
+
+    def _flush(self, loop: AbstractEventLoop):
+        batch = self._pending.pop(loop, None)
+        if batch is None:
+            return
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = loop.create_task(self._embed_batch(batch.requests))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _embed_batch(self, requests: List[Tuple[str, Future]]):
+        texts = [text for text, _ in requests]
+        try:
+            # embed as queries; embed_documents would embed them as passages.
+            # private api; relies on _embed(texts, model_type) in the pinned langchain-nvidia-ai-endpoints 0.1.2
+            vectors = await asyncio.get_running_loop().run_in_executor(None, self.embeddings._embed, texts, "query")
+            if len(vectors) != len(requests):
+                raise ValueError(f"Expected {len(requests)} embeddings, received {len(vectors)}")
+        except Exception as e:
+            for _, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), vector in zip(requests, vectors):
+            if not future.done():
+                future.set_result(vector)
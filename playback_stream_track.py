@@ -1,79 +1,160 @@
 import asyncio
-from typing import Optional
+import fractions
+import itertools
+import time
+from typing import Iterable, List, Optional
 
+import av
+import numpy as np
 from aiortc import MediaStreamTrack, RTCDataChannel
-from aiortc.contrib.media import MediaPlayer
-import os
+from av import AudioFrame
+from av.audio.resampler import AudioResampler
 import logging
 
-from aiortc.mediastreams import MediaStreamError
-
 logger = logging.getLogger("pc")
 
+SAMPLE_RATE = 48000
+CHANNELS = 2
+FRAME_SAMPLES = SAMPLE_RATE // 50  # 20ms
+FRAME_SIZE = FRAME_SAMPLES * CHANNELS
+TIME_BASE = fractions.Fraction(1, SAMPLE_RATE)
+
+
+def _to_pcm(frames: Iterable[AudioFrame]) -> np.ndarray:
+    resampler = AudioResampler(format="s16", layout="stereo", rate=SAMPLE_RATE)
+    chunks = [resampled.to_ndarray().reshape(-1)
+              for frame in itertools.chain(frames, [None])
+              for resampled in resampler.resample(frame)]
+    samples = np.concatenate(chunks) if len(chunks) > 0 else np.zeros(0, dtype=np.int16)
+    padding = -len(samples) % FRAME_SIZE if len(samples) > 0 else FRAME_SIZE
+    return np.pad(samples, (0, padding))
+
+
+def decode_audio(filename: str) -> np.ndarray:
+    """Decode an audio file into interleaved s16 stereo pcm, padded to whole 20ms frames."""
+    with av.open(filename) as container:
+        return _to_pcm(container.decode(audio=0))
+
+
+def encode_audio(audio: np.ndarray, sample_rate: int) -> np.ndarray:
+    """Convert mono float audio into interleaved s16 stereo pcm, padded to whole 20ms frames."""
+    frame = AudioFrame.from_ndarray(audio.astype(np.float32).reshape(1, -1), format="flt", layout="mono")
+    frame.sample_rate = sample_rate
+    return _to_pcm([frame])
+
 
 class PlaybackStreamTrack(MediaStreamTrack):
     kind = "audio"
-    _response_ready: bool = False
+    _silence: Optional[np.ndarray] = None
+    _response_playing: bool = False
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    # chunks from responses started before the last stop are dropped
+    _stopped_generation: int = 0
+    _response_generation: int = 0
     previous_response_silence: bool = False
-    track: MediaStreamTrack = None
-    filename: str = None
+    samples: Optional[np.ndarray] = None
+    cursor: int = 0
     counter: int = 0
-    time: float = 0.0
+    pts: int = 0
+    start: Optional[float] = None
     channel: Optional[RTCDataChannel] = None
 
     def __init__(self):
         super().__init__()  # don't forget this!
+        if PlaybackStreamTrack._silence is None:
+            PlaybackStreamTrack._silence = decode_audio("silence.wav")
+        self._pcm_queue: asyncio.Queue = asyncio.Queue()
+        # next() on a count is atomic, responses take their generation on the synthesis thread
+        self._generations = itertools.count(1)
+        self.last_response: List[np.ndarray] = []
+
+    def _put(self, pcm: Optional[np.ndarray], generation: int):
+        # responses are synthesized off the playback loop, so hand chunks over thread-safely
+        if self._loop is None:
+            self._put_unless_stopped(pcm, generation)
+        else:
+            self._loop.call_soon_threadsafe(self._put_unless_stopped, pcm, generation)
 
-    def set_filename(self, filename: str):
-        self.filename = filename
+    def _put_unless_stopped(self, pcm: Optional[np.ndarray], generation: int):
+        if generation > self._stopped_generation:
+            self._pcm_queue.put_nowait(pcm)
+
+    def start_response(self):
+        self._response_generation = next(self._generations)
+        self.last_response = []
+
+    def enqueue_response(self, audio: np.ndarray, sample_rate: int):
+        pcm = encode_audio(audio, sample_rate)
+        self.last_response.append(pcm)
+        self._put(pcm, self._response_generation)
+
+    def finish_response(self):
+        self._put(None, self._response_generation)
 
     def play_silence(self):
-        self._response_ready = False
-        # self.select_track()
+        self._stopped_generation = next(self._generations)
+        while not self._pcm_queue.empty():
+            self._pcm_queue.get_nowait()
+        self._response_playing = False
 
     def play_response(self):
-        if len(self.filename) > 0 and os.path.isfile(self.filename):
-            self._response_ready = True
-            # self.select_track()
+        if len(self.last_response) > 0:
+            generation = next(self._generations)
+            for pcm in list(self.last_response):
+                self._put(pcm, generation)
+            self._put(None, generation)
         else:
-            raise ValueError(f"filename not set or file doesn't exist. {self.filename}")
+            raise ValueError("No response has been synthesized yet.")
 
     def select_track(self):
-        logger.debug("Select track - response_ready %s", self._response_ready)
-        if self._response_ready:
-            self.track = MediaPlayer(self.filename, format="wav", loop=False).audio
+        pcm = None
+        if not self._pcm_queue.empty():
+            pcm = self._pcm_queue.get_nowait()
+            if pcm is None:
+                # end of response marker
+                self._response_playing = False
+        logger.debug("Select track - response chunk ready %s", pcm is not None)
+        if pcm is not None:
+            self.samples = pcm
             logger.debug("Playback track selected")
+            if not self._response_playing:
+                self._response_playing = True
+                self.previous_response_silence = False
+                self._send("playing: response")
+                logger.debug("Playback track playing")
         else:
-            self.track = MediaPlayer("silence.wav", format="wav", loop=False).audio
+            self.samples = self._silence
             logger.debug("Silence track selected")
+            if not self._response_playing and not self.previous_response_silence:
+                self.previous_response_silence = True
+                self._send("playing: silence")
+                logger.debug("Silence track playing")
+        self.cursor = 0
+
+    def _send(self, message: str):
         if self.channel is not None and self.channel.readyState == "open":
-            if self._response_ready:
-                self.channel.send("playing: response")
-                self.previous_response_silence = False
-                logger.debug("Playback track playing")
-            else:
-                if not self.previous_response_silence:
-                    self.channel.send("playing: silence")
-                    self.previous_response_silence = True
-                    logger.debug("Silence track playing")
+            self.channel.send(message)
 
     async def recv(self):
         self.counter += 1
-        if self.track is None:
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+        if self.samples is None:
             logger.debug("No track selected. Selecting track")
             self.select_track()
-        try:
-            async with asyncio.timeout(1):
-                frame = await self.track.recv()
-        except (MediaStreamError, TimeoutError) as e:
+        if self.start is None:
+            self.start = time.time()
+        else:
+            wait = self.start + self.pts / SAMPLE_RATE - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        if self.cursor >= len(self.samples) or (self.samples is self._silence and not self._pcm_queue.empty()):
             self.select_track()
-            if self._response_ready:
-                self._response_ready = False
-            frame = await self.track.recv()
-        except Exception as e:
-            logger.error(e)
-            raise e
-        if frame.pts < frame.sample_rate * self.time:
-            frame.pts = frame.sample_rate * self.time
-        self.time += 0.02
+        chunk = self.samples[self.cursor:self.cursor + FRAME_SIZE]
+        self.cursor += FRAME_SIZE
+        frame = AudioFrame.from_ndarray(chunk.reshape(1, -1), format="s16", layout="stereo")
+        frame.sample_rate = SAMPLE_RATE
+        frame.time_base = TIME_BASE
+        frame.pts = self.pts
+        self.pts += FRAME_SAMPLES
         return frame
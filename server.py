@@ -6,6 +6,7 @@ import os
 import ssl
 import threading
 from asyncio import create_task, AbstractEventLoop
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 from aiohttp import web
@@ -14,7 +15,7 @@ from av.audio.frame import AudioFrame
 from langchain_core.messages import HumanMessage, ToolMessage
 
 from audio_utils import Whisper, Bark
-from agent import Graph, process_image
+from agent import Graph, process_image, initialize_store
 from state import State
 
 logger = logging.getLogger("pc")
@@ -25,21 +26,33 @@ pcs = set()
 whisper: Optional[Whisper] = None
 bark: Optional[Bark] = None
 graph: Optional[Graph] = None
+bg_loop: Optional[AbstractEventLoop] = None
+
+# model inference stays on one dedicated thread per model
+stt_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stt")
+tts_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="tts")
+
+
+def read_static(filename: str) -> bytes:
+    with open(os.path.join(ROOT, filename), "rb") as f:
+        return f.read()
+
+
+INDEX_HTML = read_static("index.html")
+CLIENT_JS = read_static("client.js")
+STYLES_CSS = read_static("styles.css")
 
 
 async def index(request):
-    content = open(os.path.join(ROOT, "index.html"), "r").read()
-    return web.Response(content_type="text/html", text=content)
+    return web.Response(content_type="text/html", charset="utf-8", body=INDEX_HTML)
 
 
 async def javascript(request):
-    content = open(os.path.join(ROOT, "client.js"), "r").read()
-    return web.Response(content_type="application/javascript", text=content)
+    return web.Response(content_type="application/javascript", charset="utf-8", body=CLIENT_JS)
 
 
 async def css(request):
-    content = open(os.path.join(ROOT, "styles.css"), "r").read()
-    return web.Response(content_type="text/css", text=content)
+    return web.Response(content_type="text/css", charset="utf-8", body=STYLES_CSS)
 
 
 async def offer(request):
@@ -48,7 +61,6 @@ async def offer(request):
     offer_description = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
 
     state = State()
-    bark.set_filename(state.filename)
 
     pcs.add(state)
 
@@ -64,12 +76,12 @@ async def offer(request):
 
     async def record():
         track = state.track
-        state.log_info("Recording %s", state.filename)
+        state.log_info("Recording")
         while True:
+            # keep draining while idle, the receiver queues decoded frames whether they are read or not
             frame: AudioFrame = await track.recv()
             if state.recording:
                 state.append_frame(frame)
-            await asyncio.sleep(0)
 
     @state.pc.on("track")
     async def on_track(track: MediaStreamTrack):
@@ -103,34 +115,32 @@ async def offer(request):
             state.log_info("Received message on channel: %s", message)
             if message == "get_response":
                 state.response_player.play_response()
-            if message == "get_silence":
+            elif message == "get_silence":
                 state.response_player.play_silence()
-            if message == "start_recording":
+            elif message == "start_recording":
                 state.log_info("Start Recording")
                 state.response_player.play_silence()
                 state.buffer = []
                 state.recording = True
                 # state.counter += 1
                 # state.filename = f"{state.id}_{state.counter}.wav"
-            if message == "stop_recording":
+            elif message == "stop_recording":
                 state.log_info("Stop Recording")
                 state.recording = False
                 await asyncio.sleep(0.5)
                 data = state.flush_audio()
-                process_loop = create_bg_loop()
-                asyncio.run_coroutine_threadsafe(process_request(data), process_loop)
-            if message[0:7] == "upload:":
+                asyncio.run_coroutine_threadsafe(process_request(data), bg_loop)
+            elif message.startswith("upload:"):
                 suffix = message[7:]
                 if suffix == "START":
                     state.start_upload()
                 elif suffix == "DONE":
                     [filename, mime_type, image_data] = state.get_upload().split(":")
                     image_url = "data:%s;base64,%s" % (mime_type, image_data)
-                    process_loop = create_bg_loop()
-                    asyncio.run_coroutine_threadsafe(process_image_upload(filename, image_url), process_loop)
+                    asyncio.run_coroutine_threadsafe(process_image_upload(filename, image_url), bg_loop)
                 else:
                     state.add_upload_chunk(suffix)
-            if message[0:7] == "preset:":
+            elif message.startswith("preset:"):
                 preset = message[7:]
                 bark.set_voice_preset(preset)
                 state.log_info("Changed voice preset to %s", preset)
@@ -144,10 +154,10 @@ async def offer(request):
             continue_to_synthesize, response = await transcribe_request(data)
             if continue_to_synthesize:
                 if isinstance(response, ToolMessage) and response.name == "outfit_recommender":
-                    if response.content[0] == "[":
+                    if response.content.startswith("["):
                         images = json.loads(response.content)
                         await send_images(images)
-                    elif response.content[:5] == "Error":
+                    elif response.content.startswith("Error"):
                         channel.send("AI: " + response.content)
                         channel.send("playing: response")
                         channel.send("playing: silence")
@@ -156,15 +166,11 @@ async def offer(request):
                     state.log_info(response.content)
                     content = response.content.strip()
                     await synthesize_response(content)
-            try:
-                loop = asyncio.get_running_loop()
-                loop.stop()
-            finally:
-                pass
 
         async def transcribe_request(data):
             last_response = None
-            transcription = whisper.transcribe(data)
+            loop = asyncio.get_running_loop()
+            transcription = await loop.run_in_executor(stt_executor, whisper.transcribe, data)
             channel.send(f"Human: {transcription[0]}")
             state.log_info(transcription[0])
             await asyncio.sleep(0)
@@ -172,7 +178,7 @@ async def offer(request):
                 user_request = HumanMessage(transcription[0])
                 response = await graph.get_graph().ainvoke(state.get_context() + [user_request])
                 last_response = response[-1]
-                if last_response.content[0] != '[' and last_response.content[:5] != "Error":
+                if not last_response.content.startswith(('[', "Error")):
                     state.add_to_context(user_request)
                     state.add_to_context(last_response)
                 continue_to_synthesize = True
@@ -191,13 +197,22 @@ async def offer(request):
                     channel.send(f"image: {image}")
             await asyncio.sleep(0)
 
+        def stream_response(response):
+            player = state.response_player
+            player.start_response()
+            try:
+                for audio in bark.synthesize_stream(response):
+                    player.enqueue_response(audio, bark.sample_rate)
+            finally:
+                player.finish_response()
+
         async def synthesize_response(response):
             if len(response.strip()) > 0:
                 channel.send(f"AI: {response}")
                 await asyncio.sleep(0)
-                bark.synthesize(response)
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(tts_executor, stream_response, response)
                 channel.send(f"log: synthesized")
-                state.response_player.play_response()
             else:
                 channel.send("playing: response")
                 channel.send("playing: silence")
@@ -211,21 +226,20 @@ async def offer(request):
     )
 
 
+async def on_startup(app):
+    # the store connection is bound to the loop that opens it, so open it on the background loop
+    try:
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(initialize_store(), bg_loop))
+    except Exception as e:
+        logger.error("Failed to initialize outfit store: %s", e)
+
+
 async def on_shutdown(app):
     # close peer connections
     coros = [state.pc.close() for state in pcs]
-    for state in pcs:
-        deleteFile(state.filename)
     await asyncio.gather(*coros)
 
 
-def deleteFile(filename):
-    try:
-        os.remove(filename)
-    except OSError:
-        pass
-
-
 # https://gist.github.com/ultrafunkamsterdam/8be3d55ac45759aa1bd843ab64ce876d
 def create_bg_loop():
     def to_bg(loop):
@@ -242,7 +256,7 @@ def create_bg_loop():
             loop.close()
 
     new_loop = asyncio.new_event_loop()
-    t = threading.Thread(target=to_bg, args=(new_loop,))
+    t = threading.Thread(target=to_bg, args=(new_loop,), daemon=True)
     t.start()
     return new_loop
 
@@ -273,6 +287,7 @@ if __name__ == "__main__":
         logging.basicConfig(level=logging.INFO)
 
     graph = Graph()
+    bg_loop = create_bg_loop()
 
     if args.whisper_model:
         whisper = Whisper(model_name=args.whisper_model)
@@ -284,6 +299,10 @@ if __name__ == "__main__":
     else:
         bark = Bark()
 
+    # warm up on the inference threads so the first request doesn't pay for it
+    stt_executor.submit(whisper.warmup)
+    tts_executor.submit(bark.warmup)
+
     if args.cert_file:
         ssl_context = ssl.SSLContext()
         ssl_context.load_cert_chain(args.cert_file, args.key_file)
@@ -291,6 +310,7 @@ if __name__ == "__main__":
         ssl_context = None
 
     app = web.Application()
+    app.on_startup.append(on_startup)
     app.on_shutdown.append(on_shutdown)
     app.router.add_get("/", index)
     app.router.add_get("/client.js", javascript)
@@ -1,5 +1,4 @@
 from asyncio import Task
-import copy
 import uuid
 
 import librosa
@@ -27,10 +26,8 @@ class State:
         self.pc = RTCPeerConnection()
         self.id = str(uuid.uuid4())
         self.context = []
-        self.filename = f"audio/{self.id}.wav"
         self.response_player = PlaybackStreamTrack()
-        self.response_player.set_filename(self.filename)
-        self.partial_upload = ""
+        self.upload_chunks = []
 
     def add_to_context(self, last_message: BaseMessage):
         self.context += [last_message]
@@ -39,33 +36,28 @@ class State:
         return self.context
 
     def start_upload(self):
-        self.partial_upload = ""
+        self.upload_chunks = []
 
     def add_upload_chunk(self, chunk: str):
-        self.partial_upload += chunk
+        self.upload_chunks.append(chunk)
 
     def get_upload(self) -> str:
-        return self.partial_upload
+        return "".join(self.upload_chunks)
 
     def log_info(self, msg, *args):
         self.logger.info(self.id + " " + msg, *args)
 
     def append_frame(self, frame: AudioFrame):
-        buffer = frame.to_ndarray().flatten().astype(np.int16)
-        # check for silence
-        max_abs = np.max(np.abs(buffer))
-        if True or max_abs > 50:
-            if self.sample_rate != frame.sample_rate * 2:
-                self.sample_rate = frame.sample_rate * 2
-            self.buffer.append(buffer)
+        if self.sample_rate != frame.sample_rate * 2:
+            self.sample_rate = frame.sample_rate * 2
+        # keep a view of each frame and concatenate once in flush_audio
+        self.buffer.append(frame.to_ndarray().reshape(-1).astype(np.int16, copy=False))
 
     def flush_audio(self):
-        self.buffer = np.array(self.buffer).flatten()
-        self.log_info(f"Buffer Size: {len(self.buffer)}")
-        # write to file
-        data = copy.deepcopy(self.buffer)
-        data = librosa.util.buf_to_float(data)
+        data = np.concatenate(self.buffer) if len(self.buffer) > 0 else np.zeros(0, dtype=np.int16)
         self.buffer = []
+        self.log_info(f"Buffer Size: {len(data)}")
+        data = librosa.util.buf_to_float(data)
         if self.sample_rate != 16000:
             data = librosa.resample(data, orig_sr=self.sample_rate,
                                     target_sr=16000)
@@ -1,6 +1,10 @@
 import json
-import uuid
+import os
+from collections import OrderedDict
+from functools import lru_cache
 from operator import itemgetter
+from string import Formatter
+from types import MappingProxyType
 from typing import (
     Any,
     Callable,
@@ -9,6 +13,7 @@ from typing import (
     Literal,
     Optional,
     Sequence,
+    Tuple,
     Type,
     TypedDict,
     TypeVar,
@@ -17,8 +22,12 @@ from typing import (
     overload,
 )
 
-from langchain_core.callbacks import CallbackManagerForLLMRun
-from langchain_core.language_models import LanguageModelInput
+import orjson
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models import BaseChatModel, LanguageModelInput
 from langchain_core.messages import (
     AIMessage,
     BaseMessage,
@@ -26,15 +35,17 @@ from langchain_core.messages import (
     SystemMessage,
     ToolCall,
     ToolMessage,
+    get_buffer_string,
 )
 from langchain_core.output_parsers.base import OutputParserLike
 from langchain_core.output_parsers.json import JsonOutputParser
 from langchain_core.output_parsers.pydantic import PydanticOutputParser
-from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.outputs import ChatGeneration, ChatResult, Generation
 from langchain_core.prompts import SystemMessagePromptTemplate
-from langchain_core.pydantic_v1 import BaseModel
-from langchain_core.runnables import Runnable, RunnableLambda
+from langchain_core.pydantic_v1 import BaseModel, PrivateAttr
+from langchain_core.runnables import Runnable
 from langchain_core.runnables.base import RunnableMap
+from langchain_core.runnables.config import run_in_executor
 from langchain_core.runnables.passthrough import RunnablePassthrough
 from langchain_core.tools import BaseTool
 
@@ -50,7 +61,14 @@ You must always select one of the above tools and respond with only a JSON objec
 }}
 """  # noqa: E501
 
-DEFAULT_RESPONSE_FUNCTION = {
+DEFAULT_BATCH_TEMPLATE = """Answer each of the following {count} queries independently.
+
+{queries}
+
+Respond with only a JSON array of {count} objects, one for each query in the same order, each matching the above schema.
+"""  # noqa: E501
+
+DEFAULT_RESPONSE_FUNCTION = MappingProxyType({
     "name": "__conversational_response",
     "description": (
         "Respond conversationally if no other tools should be called for a given query."
@@ -65,6 +83,15 @@ DEFAULT_RESPONSE_FUNCTION = {
         },
         "required": ["response"],
     },
+})
+
+_DEFAULT_RESPONSE_TOOLS = (DEFAULT_RESPONSE_FUNCTION,)
+
+_ROLE_MAP: Dict[Type[BaseMessage], str] = {
+    HumanMessage: "user",
+    AIMessage: "assistant",
+    ToolMessage: "assistant",
+    SystemMessage: "system",
 }
 
 _BM = TypeVar("_BM", bound=BaseModel)
@@ -106,13 +133,65 @@ def convert_to_ollama_tool(tool: Any) -> Dict:
     return definition
 
 
+# entries pin the objects whose ids they are keyed by, so the per-instance caches are bounded
+_INSTANCE_CACHE_SIZE = 32
+
+
+def _cache_get(cache: OrderedDict, key: Tuple) -> Any:
+    entry = cache.get(key)
+    if entry is not None:
+        try:
+            cache.move_to_end(key)
+        except KeyError:
+            # evicted by another thread in the meantime
+            pass
+    return entry
+
+
+def _cache_put(cache: OrderedDict, key: Tuple, entry: Any) -> None:
+    cache[key] = entry
+    while len(cache) > _INSTANCE_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+@lru_cache(maxsize=None)
+def _system_message_prompt_template(template: str) -> SystemMessagePromptTemplate:
+    return SystemMessagePromptTemplate.from_template(template)
+
+
+_DECODER = json.JSONDecoder()
+
+
+@lru_cache(maxsize=None)
+def _split_system_template(template: str) -> Optional[Tuple[str, str]]:
+    """Split an f-string template whose only variable is `tools` into the text around it."""
+    parts: Tuple[List[str], List[str]] = ([], [])
+    fields = 0
+    try:
+        for literal_text, field_name, format_spec, conversion in Formatter().parse(template):
+            parts[fields].append(literal_text)
+            if field_name is not None:
+                if fields or field_name != "tools" or format_spec or conversion:
+                    return None
+                fields += 1
+    except ValueError:
+        return None
+    if fields != 1:
+        return None
+    return "".join(parts[0]), "".join(parts[1])
+
+
 def parse_json_garbage(s):
-    s = s[next(idx for idx, c in enumerate(s) if c in "{["):]
+    starts = [idx for idx in (s.find("{"), s.find("[")) if idx != -1]
+    if not starts:
+        raise json.JSONDecodeError("Expecting value", s, 0)
+    start = min(starts)
     try:
-        response = json.loads(s)
+        response = orjson.loads(s[start:])
         return response
-    except (json.JSONDecodeError, ValueError) as e:
-        response = json.loads(s[:e.pos])
+    except orjson.JSONDecodeError:
+        # trailing text after the document; decode the first value and ignore the rest
+        response, _ = _DECODER.raw_decode(s, start)
         return response
 
 
@@ -130,7 +209,7 @@ def parse_response(message: BaseMessage) -> str:
         if len(tool_calls) > 0:
             tool_call = tool_calls[-1]
             args = tool_call.get("args")
-            return json.dumps(args)
+            return orjson.dumps(args).decode()
         elif "function_call" in kwargs:
             if "arguments" in kwargs["function_call"]:
                 return kwargs["function_call"]["arguments"]
@@ -142,11 +221,36 @@ def parse_response(message: BaseMessage) -> str:
     raise ValueError(f"`message` is not an instance of `AIMessage`: {message}")
 
 
+class _ToolCallPydanticParser(PydanticOutputParser):
+    """Parses the arguments of the last tool call in an `AIMessage` into a Pydantic object."""
+
+    def parse_result(self, result: List[Generation], *, partial: bool = False) -> Any:
+        text = parse_response(cast(ChatGeneration, result[0]).message)
+        return super().parse_result([Generation(text=text)], partial=partial)
+
+
+class _ToolCallJsonParser(JsonOutputParser):
+    """Parses the arguments of the last tool call in an `AIMessage` into a dict."""
+
+    def parse_result(self, result: List[Generation], *, partial: bool = False) -> Any:
+        text = parse_response(cast(ChatGeneration, result[0]).message)
+        return super().parse_result([Generation(text=text)], partial=partial)
+
+
 def create_tool_calling_model(model: type, model_name: str):
     class ToolCallingModel(model):
         """Function chat model that uses Ollama API."""
 
         tool_system_prompt_template: str = DEFAULT_SYSTEM_TEMPLATE
+        batch_prompt_template: str = DEFAULT_BATCH_TEMPLATE
+        # (template id, *tool ids) -> (template and bound tools, tools by name, system message)
+        _tool_cache: "OrderedDict[Tuple, Tuple[Tuple, Dict[str, Dict], BaseMessage]]" = PrivateAttr(
+            default_factory=OrderedDict
+        )
+        # (schema id, include_raw) -> (schema, structured output chain)
+        _structured_chain_cache: "OrderedDict[Tuple, Tuple[Any, Runnable]]" = PrivateAttr(
+            default_factory=OrderedDict
+        )
 
         def __init__(self, **kwargs: Any) -> None:
             super().__init__(**kwargs)
@@ -288,53 +392,61 @@ def create_tool_calling_model(model: type, model_name: str):
                     "schema must be specified when method is 'function_calling'. "
                     "Received None."
                 )
+            key = (id(schema), bool(include_raw))
+            cached = _cache_get(self._structured_chain_cache, key)
+            if cached is not None:
+                return cached[1]
             llm = self.bind_tools(tools=[schema])
             if is_pydantic_schema:
-                output_parser: OutputParserLike = PydanticOutputParser(
+                output_parser: OutputParserLike = _ToolCallPydanticParser(
                     pydantic_object=schema
                 )
             else:
-                output_parser = JsonOutputParser()
+                output_parser = _ToolCallJsonParser()
 
-            parser_chain = RunnableLambda(parse_response) | output_parser
             if include_raw:
                 parser_assign = RunnablePassthrough.assign(
-                    parsed=itemgetter("raw") | parser_chain, parsing_error=lambda _: None
+                    parsed=itemgetter("raw") | output_parser, parsing_error=lambda _: None
                 )
                 parser_none = RunnablePassthrough.assign(parsed=lambda _: None)
                 parser_with_fallback = parser_assign.with_fallbacks(
                     [parser_none], exception_key="parsing_error"
                 )
-                return RunnableMap(raw=llm) | parser_with_fallback
+                chain = RunnableMap(raw=llm) | parser_with_fallback
             else:
-                return llm | parser_chain
+                chain = llm | output_parser
+            # keep the schema alive so its id can't be reused by another object
+            _cache_put(self._structured_chain_cache, key, (schema, chain))
+            return chain
 
         def _convert_messages_to_ollama_messages(
                 self, messages: List[BaseMessage]
         ) -> List[Dict[str, Union[str, List[str]]]]:
             ollama_messages: List = []
             for message in messages:
-                role = ""
-                if isinstance(message, HumanMessage):
-                    role = "user"
-                elif isinstance(message, AIMessage) or isinstance(message, ToolMessage):
-                    role = "assistant"
-                elif isinstance(message, SystemMessage):
-                    role = "system"
-                else:
-                    raise ValueError("Received unsupported message type for Ollama.")
+                role = _ROLE_MAP.get(type(message))
+                if role is None:
+                    # subclasses such as message chunks
+                    role = next(
+                        (r for cls, r in _ROLE_MAP.items() if isinstance(message, cls)), None
+                    )
+                    if role is None:
+                        raise ValueError("Received unsupported message type for Ollama.")
 
                 content = ""
                 images = []
                 if isinstance(message.content, str):
                     content = message.content
                 else:
-                    for content_part in cast(List[Dict], message.content):
-                        if content_part.get("type") == "text":
-                            content += f"\n{content_part['text']}"
-                        elif content_part.get("type") == "image_url":
-                            if isinstance(content_part.get("image_url"), str):
-                                image_url_components = content_part["image_url"].split(",")
+                    text_parts = []
+                    for content_part in message.content:
+                        part_type = content_part.get("type")
+                        if part_type == "text":
+                            text_parts.append(f"\n{content_part['text']}")
+                        elif part_type == "image_url":
+                            image_url = content_part.get("image_url")
+                            if isinstance(image_url, str):
+                                image_url_components = image_url.split(",")
                                 # Support data:image/jpeg;base64,<image> format
                                 # and base64 strings
                                 if len(image_url_components) > 1:
@@ -351,6 +463,7 @@ def create_tool_calling_model(model: type, model_name: str):
                                 "Must either have type 'text' or type 'image_url' "
                                 "with a string 'image_url' field."
                             )
+                    content = "".join(text_parts)
 
                 ollama_messages.append(
                     {
@@ -362,13 +475,31 @@ def create_tool_calling_model(model: type, model_name: str):
 
             return ollama_messages
 
-        def _generate(
-                self,
-                messages: List[BaseMessage],
-                stop: Optional[List[str]] = None,
-                run_manager: Optional[CallbackManagerForLLMRun] = None,
-                **kwargs: Any,
-        ) -> ChatResult:
+        def _get_tools_and_system_message(
+                self, functions: Sequence
+        ) -> Tuple[Dict[str, Dict], BaseMessage]:
+            key = (id(self.tool_system_prompt_template),) + tuple(id(fn) for fn in functions)
+            cached = _cache_get(self._tool_cache, key)
+            if cached is None:
+                converted = [*map(convert_to_ollama_tool, functions), *_DEFAULT_RESPONSE_TOOLS]
+                tools = orjson.dumps(converted, default=dict, option=orjson.OPT_INDENT_2).decode()
+                split_template = _split_system_template(self.tool_system_prompt_template)
+                if split_template is not None:
+                    system_message = SystemMessage(
+                        content=split_template[0] + tools + split_template[1]
+                    )
+                else:
+                    system_message = _system_message_prompt_template(
+                        self.tool_system_prompt_template
+                    ).format(tools=tools)
+                # first tool wins on duplicate names
+                tools_by_name = {fn["name"]: fn for fn in reversed(converted)}
+                # keep the keyed objects alive so their ids can't be reused by other objects
+                cached = ((self.tool_system_prompt_template, *functions), tools_by_name, system_message)
+                _cache_put(self._tool_cache, key, cached)
+            return cached[1], cached[2]
+
+        def _prepare_tools(self, kwargs: Dict[str, Any]) -> Tuple[Dict[str, Dict], BaseMessage]:
             functions = kwargs.get("functions", [])
             if "functions" in kwargs:
                 del kwargs["functions"]
@@ -382,34 +513,30 @@ def create_tool_calling_model(model: type, model_name: str):
                         "matching function in `functions`."
                     )
                 del kwargs["function_call"]
-            functions = [convert_to_ollama_tool(fn) for fn in functions]
-            functions.append(DEFAULT_RESPONSE_FUNCTION)
-            system_message_prompt_template = SystemMessagePromptTemplate.from_template(
-                self.tool_system_prompt_template
-            )
-            system_message = system_message_prompt_template.format(
-                tools=json.dumps(functions, indent=2)
-            )
-            response_message = super()._generate(
-                [system_message] + messages, stop=stop, run_manager=run_manager, **kwargs
-            )
-            chat_generation_content = response_message.generations[0].text
+            return self._get_tools_and_system_message(functions)
+
+        def _parse_json_output(self, chat_generation_content: Any) -> Any:
             if not isinstance(chat_generation_content, str):
                 raise ValueError("OllamaFunctions does not support non-string output.")
             try:
-                parsed_chat_result = parse_json_garbage(chat_generation_content)
+                return parse_json_garbage(chat_generation_content)
             except json.JSONDecodeError:
                 raise ValueError(
                     f"""'{self.model}' did not respond with valid JSON. 
                     Please try again. 
                     Response: {chat_generation_content}"""
                 )
+
+        def _to_chat_result(
+                self,
+                parsed_chat_result: Dict[str, Any],
+                tools_by_name: Dict[str, Dict],
+                chat_generation_content: str,
+        ) -> ChatResult:
             called_tool_name = (
                 parsed_chat_result["tool"] if "tool" in parsed_chat_result else None
             )
-            called_tool = next(
-                (fn for fn in functions if fn["name"] == called_tool_name), None
-            )
+            called_tool = tools_by_name.get(called_tool_name)
             if (
                     called_tool is None
                     or called_tool["name"] == DEFAULT_RESPONSE_FUNCTION["name"]
@@ -448,7 +575,7 @@ def create_tool_calling_model(model: type, model_name: str):
                     ToolCall(
                         name=called_tool_name,
                         args=called_tool_arguments if called_tool_arguments else {},
-                        id=f"call_{str(uuid.uuid4()).replace('-', '')}",
+                        id=f"call_{os.urandom(16).hex()}",
                     )
                 ],
             )
@@ -457,6 +584,100 @@ def create_tool_calling_model(model: type, model_name: str):
                 generations=[ChatGeneration(message=response_message_with_functions)]
             )
 
+        def _generate(
+                self,
+                messages: List[BaseMessage],
+                stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                **kwargs: Any,
+        ) -> ChatResult:
+            tools_by_name, system_message = self._prepare_tools(kwargs)
+            response_message = super()._generate(
+                [system_message] + messages, stop=stop, run_manager=run_manager, **kwargs
+            )
+            chat_generation_content = response_message.generations[0].text
+            parsed_chat_result = self._parse_json_output(chat_generation_content)
+            return self._to_chat_result(
+                parsed_chat_result, tools_by_name, chat_generation_content
+            )
+
+        async def _agenerate(
+                self,
+                messages: List[BaseMessage],
+                stop: Optional[List[str]] = None,
+                run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+                **kwargs: Any,
+        ) -> ChatResult:
+            tools_by_name, system_message = self._prepare_tools(kwargs)
+            if model._agenerate is BaseChatModel._agenerate:
+                # the default _agenerate runs self._generate, which would add the tools prompt again
+                response_message = await run_in_executor(
+                    None,
+                    super()._generate,
+                    [system_message] + messages,
+                    stop,
+                    run_manager.get_sync() if run_manager else None,
+                    **kwargs,
+                )
+            else:
+                response_message = await super()._agenerate(
+                    [system_message] + messages, stop=stop, run_manager=run_manager, **kwargs
+                )
+            chat_generation_content = response_message.generations[0].text
+            parsed_chat_result = self._parse_json_output(chat_generation_content)
+            return self._to_chat_result(
+                parsed_chat_result, tools_by_name, chat_generation_content
+            )
+
+        def batch_generate(
+                self,
+                batches: List[List[BaseMessage]],
+                stop: Optional[List[str]] = None,
+                run_manager: Optional[CallbackManagerForLLMRun] = None,
+                max_batch_size: int = 8,
+                **kwargs: Any,
+        ) -> List[ChatResult]:
+            """Generate tool calls for several independent conversations.
+
+            Up to `max_batch_size` conversations are numbered into a single prompt and the
+            model is asked for a JSON array with one tool call object per conversation, so
+            each group costs one model call. Results are returned in the order of `batches`.
+            """
+            if max_batch_size < 1:
+                raise ValueError("max_batch_size must be at least 1.")
+            tools_by_name, system_message = self._prepare_tools(kwargs)
+            results: List[ChatResult] = []
+            for offset in range(0, len(batches), max_batch_size):
+                group = batches[offset:offset + max_batch_size]
+                queries = "\n\n".join(
+                    f"### Query {idx}\n{get_buffer_string(messages)}"
+                    for idx, messages in enumerate(group, start=1)
+                )
+                prompt = HumanMessage(
+                    content=self.batch_prompt_template.format(count=len(group), queries=queries)
+                )
+                response_message = super()._generate(
+                    [system_message, prompt], stop=stop, run_manager=run_manager, **kwargs
+                )
+                chat_generation_content = response_message.generations[0].text
+                parsed_chat_results = self._parse_json_output(chat_generation_content)
+                if isinstance(parsed_chat_results, dict):
+                    parsed_chat_results = [parsed_chat_results]
+                if (
+                        not isinstance(parsed_chat_results, list)
+                        or len(parsed_chat_results) != len(group)
+                        or not all(isinstance(result, dict) for result in parsed_chat_results)
+                ):
+                    raise ValueError(
+                        f"'{self.model}' did not respond with {len(group)} tool calls. "
+                        f"Response: {chat_generation_content}"
+                    )
+                results.extend(
+                    self._to_chat_result(parsed_chat_result, tools_by_name, chat_generation_content)
+                    for parsed_chat_result in parsed_chat_results
+                )
+            return results
+
         @property
         def _llm_type(self) -> str:
             return model_name